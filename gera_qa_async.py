@@ -4,13 +4,19 @@ gera_qa_async.py
 Gera até 3 perguntas distintas por contrato usando Ollama (llama4) e asyncio.
 
 Uso:
-    python3 gera_qa_async.py contratos_clean.csv --n-paraphrases 3 --concurrency 8
+    python3 gera_qa_async.py contratos_clean.csv --n-paraphrases 3 --concurrency 8 --batch 8 [--qpm 50]
 
 Variáveis de ambiente opcionais:
     LLAMA_URL   – URL /api/generate  (default: http://164.41.75.221:11434/api/generate)
     MODEL_NAME  – nome do modelo    (default: llama4)
 """
-import argparse, asyncio, csv, json, os, re, time, shutil, httpx, pathlib
+import argparse, asyncio, contextlib, csv, errno, itertools, mmap, os, random, re, time, aiohttp, pathlib
+import orjson
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+from aiolimiter import AsyncLimiter
 
 # ───────── CONFIG ───────── #
 API_URL   = os.getenv("LLAMA_URL",  "http://164.41.75.221:11434/api/generate")
@@ -18,6 +24,10 @@ MODEL     = os.getenv("MODEL_NAME", "llama4")
 TEMP      = 0.5
 OBJ_LIMIT = 350
 RETRIES   = 3
+BACKOFF   = 1.5      # base (s) do backoff exponencial: 3s, 6s, ... + jitter
+KEEP_ALIVE  = "30m"  # mantém o modelo residente na VRAM entre chamadas
+NUM_CTX     = 8192   # fixo: mudar num_ctx entre chamadas força o Ollama a recarregar
+NUM_PREDICT = 256    # tokens de saída por item do lote
 OUTFILE   = "qa_pairs.jsonl"
 
 PROMPT_TMPL = """Você é um sistema gerador de dados sintéticos para QA.
@@ -30,125 +40,273 @@ Resposta: <valor>
 OBJETO: {obj}
 VALOR: {val}"""
 
+# vários contratos num único prompt: N itens → uma só requisição
+PROMPT_BATCH_TMPL = """Você é um sistema gerador de dados sintéticos para QA.
+Para CADA um dos {n} itens abaixo, dado seu OBJETO e seu VALOR, crie {k} perguntas
+distintas, claras e sem repetir estrutura, cuja resposta exata seja o VALOR do próprio item.
+Formato (uma pergunta por linha):
+ITEM 1 P1: <pergunta 1 do item 1>
+ITEM 1 P2: <pergunta 2 do item 1>
+...
+ITEM 2 P1: <pergunta 1 do item 2>
+...
+{itens}"""
+ITEM_TMPL = """ITEM {idx}:
+OBJETO: {obj}
+VALOR: {val}"""
+FICLONE = 0x40049409  # ioctl de reflink (Linux: btrfs, XFS, ...)
+# erros que só dizem "este FS/SO não faz reflink"
+_NO_REFLINK = {errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP, errno.ENOTTY,
+               errno.EINVAL, errno.ENOSYS}
+
+_SLUG_RE = re.compile(r"\W+")
+_PQ_RE   = re.compile(r"^P\d+\s*:", re.I)
+# "id" é sempre o primeiro campo de cada linha (ver process_batch); captura a
+# chave do contrato "<slug>_<versao>" de um id "<slug>_<versao>_v<i>"
+_ID_RE   = re.compile(rb'^\{"id":\s*"(.+?_\d{2,})_v\d+"', re.M)
+_ITEM_RE     = re.compile(r"^ITEM\s*(\d+)\s*P(\d+)\s*:\s*(.+)$", re.I)
+_ITEM_HDR_RE = re.compile(r"^ITEM\s*(\d+)\s*:\s*$", re.I)
+
 def slug(txt, n=60):
-    return re.sub(r"\W+","_",txt.lower()).strip("_")[:n]
+    return _SLUG_RE.sub("_", txt.lower()).strip("_")[:n]
+
+def reflink(src, dst):
+    """Cópia copy-on-write de src em dst (novo): O(1) e ponto-no-tempo. False se não suportado."""
+    if fcntl is None:
+        return False
+    ok = False
+    try:
+        with open(src, "rb") as fs, open(dst, "xb") as fd:
+            try:
+                fcntl.ioctl(fd.fileno(), FICLONE, fs.fileno())
+                ok = True
+            except OSError as e:
+                if e.errno not in _NO_REFLINK:
+                    raise
+    finally:
+        if not ok and os.path.exists(dst):
+            os.remove(dst)
+    return ok
+
+def backup_output(path):
+    """
+    Guarda o estado anterior do jsonl. O arquivo só recebe append, então o tamanho
+    pré-execução basta para restaurá-lo (truncate); onde o FS permite, tira também
+    um reflink ponto-no-tempo, sem custo de cópia.
+    """
+    size = os.path.getsize(path)
+    ts = time.strftime("%Y%m%d-%H%M%S")
+    bak, n = f"{path}.bak-{ts}", 1
+    while os.path.exists(bak):  # duas execuções no mesmo segundo
+        bak, n = f"{path}.bak-{ts}-{n}", n + 1
+    if reflink(path, bak):
+        print(f"🔒 backup (reflink) salvo em {bak}")
+    print(f"🔒 {path} tinha {size} bytes antes desta execução; "
+          f"para desfazê-la: truncate -s {size} {path}")
 
 def prepare_output(path=OUTFILE):
     """
-    1) Lê todos os IDs já gerados em done_ids.
-    2) Faz backup *por cópia* do arquivo atual (sem removê-lo).
+    1) Lê as chaves "<slug>_<versao>" já geradas em done_ids (regex sobre mmap,
+       sem json.loads).
+    2) Registra o estado anterior do arquivo (ver backup_output), sem copiá-lo.
     3) Abre para append e retorna (file_handle, done_ids).
     """
     done_ids = set()
     if os.path.exists(path):
-        with open(path, encoding="utf-8") as f:
-            for ln in f:
-                try:
-                    done_ids.add(json.loads(ln)["id"])
-                except:
-                    continue
-        # backup por cópia
-        ts = time.strftime("%Y%m%d-%H%M%S")
-        bak = f"{path}.bak-{ts}"
-        shutil.copy(path, bak)
-        print(f"🔒 backup salvo em {bak}")
-    # abrir em modo append: não trunca o arquivo
-    f_out = open(path, "a", encoding="utf-8")
+        if os.path.getsize(path):
+            with open(path, "rb") as f, \
+                 mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                done_ids = {m.group(1).decode("utf-8") for m in _ID_RE.finditer(mm)}
+        backup_output(path)
+    # abrir em modo append (binário, buffer grande): não trunca o arquivo
+    f_out = open(path, "ab", buffering=1 << 20)
     return f_out, done_ids
 
-async def call_llm(client, obj, val, k):
-    obj_trim = (obj[:OBJ_LIMIT] + "…") if len(obj) > OBJ_LIMIT else obj
-    prompt = PROMPT_TMPL.format(obj=obj_trim, val=val, k=k)
-    payload = {"model": MODEL, "prompt": prompt,
-               "temperature": TEMP, "stream": False}
+def build_prompt(items, k):
+    """items = [(obj, val), ...]; um item usa o prompt simples, vários o de lote."""
+    trim = lambda obj: (obj[:OBJ_LIMIT] + "…") if len(obj) > OBJ_LIMIT else obj
+    if len(items) == 1:
+        obj, val = items[0]
+        return PROMPT_TMPL.format(obj=trim(obj), val=val, k=k)
+    itens = "\n".join(ITEM_TMPL.format(idx=idx, obj=trim(obj), val=val)
+                      for idx, (obj, val) in enumerate(items, 1))
+    return PROMPT_BATCH_TMPL.format(n=len(items), k=k, itens=itens)
+
+def backoff(attempt, retry_after=None):
+    """Espera antes da próxima tentativa: Retry-After se vier em segundos, senão 2^n*base + jitter."""
+    if retry_after and retry_after.isdigit():
+        return min(60, int(retry_after))
+    return min(60, (2 ** attempt) * BACKOFF) + random.uniform(0, BACKOFF)
+
+async def call_llm(client, items, k):
+    prompt = build_prompt(items, k)
+    payload = {"model": MODEL, "prompt": prompt, "stream": False,
+               "keep_alive": KEEP_ALIVE,
+               "options": {"temperature": TEMP, "num_ctx": NUM_CTX,
+                           "num_predict": NUM_PREDICT * len(items)}}
 
     for attempt in range(1, RETRIES + 1):
         try:
-            r = await client.post(API_URL, json=payload, timeout=60)
-            if r.status_code == 500:
-                raise httpx.HTTPStatusError("500 from Ollama",
-                                            request=r.request, response=r)
-            r.raise_for_status()
-            return r.json()["response"]
-        except Exception as e:
+            async with client.post(API_URL, json=payload) as r:
+                r.raise_for_status()
+                data = await r.json()
+            return data["response"]
+        except aiohttp.ClientResponseError as e:
+            # 4xx (exceto 429) é permanente: repetir não adianta
+            if (400 <= e.status < 500 and e.status != 429) or attempt == RETRIES:
+                raise
+            delay = backoff(attempt, (e.headers or {}).get("Retry-After"))
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
             if attempt == RETRIES:
                 raise
-            await asyncio.sleep(3 * attempt)
+            delay = backoff(attempt)
+        await asyncio.sleep(delay)
 
 def extract_questions(text, k):
     lines = [l.strip() for l in text.splitlines() if l.strip()]
     qs = [l.split(":",1)[1].strip()
-          for l in lines if re.match(r"^P\d+\s*:", l, re.I)]
+          for l in lines if _PQ_RE.match(l)]
     if not qs:
         raise ValueError("Resposta sem perguntas:\n" + text)
     return qs[:k]
 
-async def worker(queue, writer, done_ids, k):
-    async with httpx.AsyncClient() as client:
-        while True:
-            item = await queue.get()
-            if item is None:
-                queue.task_done()
-                break
+def extract_batch(text, k):
+    """
+    Agrupa as perguntas por item → {i: [perguntas]}. Aceita tanto 'ITEM i Pj: ...'
+    numa linha quanto um cabeçalho 'ITEM i:' seguido de linhas 'Pj: ...'.
+    """
+    por_item, atual = {}, None
+    for l in (l.strip() for l in text.splitlines()):
+        if m := _ITEM_RE.match(l):
+            por_item.setdefault(int(m.group(1)), []).append(m.group(3).strip())
+        elif m := _ITEM_HDR_RE.match(l):
+            atual = int(m.group(1))
+        elif atual is not None and _PQ_RE.match(l):
+            por_item.setdefault(atual, []).append(l.split(":", 1)[1].strip())
+    return {idx: qs[:k] for idx, qs in por_item.items()}
+
+async def gen_questions(client, sem, limiter, items, k):
+    async with sem, limiter:
+        resp = await call_llm(client, items, k)
+    if len(items) == 1:
+        return {1: extract_questions(resp, k)}
+    return extract_batch(resp, k)
 
-            uid_base, obj, val, versao = item
-            if f"{uid_base}_v0" in done_ids:
-                queue.task_done()
-                continue
+def contract_key(uid_base, versao):
+    """Chave de um contrato em done_ids; prefixo dos ids "<chave>_v<i>" no jsonl."""
+    return f"{uid_base}_{versao:02d}"
 
-            try:
-                resp = await call_llm(client, obj, val, k)
-                qs = extract_questions(resp, k)
-                for i, q in enumerate(qs):
-                    uid = f"{uid_base}_{versao:02d}_v{i}"
-                    json.dump({
-                        "id":       uid,
-                        "question": q,
-                        "answer":   val,
-                        "objeto":   obj,
-                        "valor":    val
-                    }, writer, ensure_ascii=False)
-                    writer.write("\n")
-                print(".", end="", flush=True)
-            except Exception as e:
-                print(f"\n⚠️ erro {type(e).__name__}: {e} – {obj[:60]}…")
-
-            done_ids.add(f"{uid_base}_v0")
-            queue.task_done()
-
-async def main(csv_in, n_para, conc):
+async def process_batch(client, sem, limiter, batch, writer, lock, done_ids, k):
+    """Gera e grava as perguntas do lote; devolve quantos contratos ganharam QA."""
+    # reserva a chave já ao pegar a linha: as tasks nascem todas antes de qualquer
+    # resposta, então marcar só depois da chamada não pegaria as repetições
+    pend = []
+    for item in batch:
+        key = contract_key(item[0], item[3])
+        if key not in done_ids:
+            done_ids.add(key)
+            pend.append(item)
+    if not pend:
+        return 0
+
+    por_item = {}
+    if len(pend) > 1:
+        try:
+            por_item = await gen_questions(client, sem, limiter,
+                                           [(obj, val) for _, obj, val, _ in pend], k)
+        except Exception as e:
+            # falha de rede/HTTP já passou pelos retries de call_llm: não multiplica
+            # em uma chamada por item, só registra os itens do lote como falhos
+            print(f"\n⚠️ lote falhou ({type(e).__name__}: {e}) – {len(pend)} itens")
+            return 0
+
+    # itens ausentes na resposta do lote (ou lote unitário): chamadas individuais,
+    # todas em paralelo
+    faltando = [idx for idx in range(1, len(pend) + 1) if not por_item.get(idx)]
+    res = await asyncio.gather(*(gen_questions(client, sem, limiter, [pend[idx - 1][1:3]], k)
+                                 for idx in faltando), return_exceptions=True)
+    for idx, r in zip(faltando, res):
+        por_item[idx] = r if isinstance(r, Exception) else r[1]
+
+    buf, novos = bytearray(), 0
+    for idx, (uid_base, obj, val, versao) in enumerate(pend, 1):
+        try:
+            qs = por_item[idx]
+            if isinstance(qs, Exception):
+                raise qs
+            for i, q in enumerate(qs):
+                uid = f"{contract_key(uid_base, versao)}_v{i}"
+                # "id" deve continuar sendo a primeira chave (_ID_RE depende disso)
+                buf += orjson.dumps({
+                    "id":       uid,
+                    "question": q,
+                    "answer":   val,
+                    "objeto":   obj,
+                    "valor":    val
+                }) + b"\n"
+            novos += 1
+            print(".", end="", flush=True)
+        except Exception as e:
+            print(f"\n⚠️ erro {type(e).__name__}: {e} – {obj[:60]}…")
+
+    # uma única escrita por lote, sem intercalar linhas de outras tasks
+    if buf:
+        async with lock:
+            writer.write(buf)
+    return novos
+
+def read_batches(csv_in, batch):
+    """Lê o CSV em lotes de até `batch` itens (uid_base, obj, val, versao)."""
+    with open(csv_in, newline="", encoding="utf-8") as f:
+        rows = ((slug(row["objeto_contrato"]),
+                 row["objeto_contrato"],
+                 row["valor_contrato"],
+                 int(row.get("versao_idx", 0)))
+                for row in csv.DictReader(f))
+        while chunk := list(itertools.islice(rows, batch)):
+            yield chunk
+
+async def main(csv_in, n_para, conc, qpm=None, batch=8):
     # prepara saída e done_ids
     out, done_ids = prepare_output(OUTFILE)
+    prev = len(done_ids)
 
-    # enfileira
-    queue = asyncio.Queue()
-    total = 0
-    with open(csv_in, newline="", encoding="utf-8") as f:
-        for row in csv.DictReader(f):
-            total += 1
-            base = slug(row["objeto_contrato"])
-            vers = int(row.get("versao_idx", 0))
-            queue.put_nowait((base,
-                              row["objeto_contrato"],
-                              row["valor_contrato"],
-                              vers))
-
-    # dispara workers
-    workers = [asyncio.create_task(worker(queue, out, done_ids, n_para))
-               for _ in range(conc)]
-
-    await queue.join()
-    for _ in workers:
-        queue.put_nowait(None)
-    await asyncio.gather(*workers)
+    # no máximo `conc` chamadas em voo e, se pedido, no máximo `qpm` por minuto
+    sem = asyncio.Semaphore(conc)
+    lock = asyncio.Lock()
+    limiter = AsyncLimiter(qpm, 60) if qpm else contextlib.nullcontext()
+
+    # uma única sessão compartilhada: reaproveita conexões keep-alive
+    pool = max(64, conc * 2)
+    connector = aiohttp.TCPConnector(limit=pool, limit_per_host=pool,
+                                     ttl_dns_cache=300, keepalive_timeout=60)
+    timeout = aiohttp.ClientTimeout(total=60, connect=10)
+    async with aiohttp.ClientSession(connector=connector,
+                                     timeout=timeout) as client:
+        # o CSV é lido numa thread, lote a lote, enquanto os anteriores já vão
+        # para a rede; a TaskGroup propaga na hora qualquer erro não tratado
+        batches = read_batches(csv_in, batch)
+        total, tasks = 0, []
+        async with asyncio.TaskGroup() as tg:
+            while chunk := await asyncio.to_thread(next, batches, None):
+                total += len(chunk)
+                tasks.append(tg.create_task(process_batch(client, sem, limiter, chunk,
+                                                          out, lock, done_ids, n_para)))
+    novos = sum(t.result() for t in tasks)
 
     out.close()
-    print(f"\n✅ concluído. Lidos: {total}, QA distintos agora: {len(done_ids)}")
+    print(f"\n✅ concluído. Lidos: {total}, novos: {novos}, "
+          f"contratos com QA agora: {prev + novos}")
 
 if __name__ == "__main__":
     p = argparse.ArgumentParser()
     p.add_argument("csv_in")
     p.add_argument("--n-paraphrases", "-k", type=int, default=3)
     p.add_argument("--concurrency",   "-c", type=int, default=8)
+    p.add_argument("--qpm", type=int, default=None,
+                   help="máximo de requisições por minuto ao Ollama")
+    p.add_argument("--batch",         "-b", type=int, default=8,
+                   help="contratos por prompt")
     args = p.parse_args()
-    asyncio.run(main(args.csv_in, args.n_paraphrases, args.concurrency))
+    asyncio.run(main(args.csv_in, args.n_paraphrases, args.concurrency,
+                     args.qpm, args.batch))
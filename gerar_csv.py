@@ -1,73 +1,97 @@
+import gc
 import hashlib
 import pickle
 import re
 
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
 
 PICKLE_IN = "data/corpus_by_atos_contratos.pkl"
 CSV_OUT = "contratos_clean_composite_key.csv"
-
-def normalize_valor(valor_raw: str) -> str | None:
-    """Transforma qualquer 'R$ 1.000,50' ou '1000.50' em 'R$ 1.000,50'."""
-    v = re.sub(r"[^\d,\.]", "", valor_raw).replace(".", "").replace(",", ".")
-    try:
-        num = float(v)
-        return f"R$ {num:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
-    except ValueError:
-        return None
+META_COLS = ["objeto_contrato", "valor_contrato", "processo_gdf", "numero_contrato"]
+
+_VAL_STRIP = re.compile(r"[^\d,\.]")
+_WS_RE = re.compile(r"\s+")
+
+def normalize_valor(valor_raw: pd.Series) -> pd.Series:
+    """Transforma qualquer 'R$ 1.000,50' ou '1000.50' em 'R$ 1.000,50' (NaN se inválido)."""
+    v = (valor_raw.str.replace(_VAL_STRIP, "", regex=True)
+                  .str.replace(".", "", regex=False)
+                  .str.replace(",", ".", regex=False))
+    num = pd.to_numeric(v, errors="coerce")
+    return num.map(
+        lambda x: f"R$ {x:,.2f}".replace(",", "X").replace(".", ",").replace("X", "."),
+        na_action="ignore",
+    )
+
+def bhash(b: bytes) -> str:
+    # Chave de deduplicação, não criptográfica: BLAKE2b de 6 bytes = 12 hex (mesma largura do SHA-1[:12])
+    return hashlib.blake2b(b, digest_size=6).hexdigest()
 
 def sha12(txt: str) -> str:
-    return hashlib.sha1(txt.encode("utf-8")).hexdigest()[:12]
-
-def make_composite_key(meta: dict) -> str:
-    obj = re.sub(r"\s+", " ", meta.get("objeto_contrato", "")).strip()
-    obj_hash = sha12(obj) if obj else "no_obj_hash"
-    processo = meta.get("processo_gdf", "unknown_processo")
-    numero = meta.get("numero_contrato", "unknown_numero")
-    return f"{obj_hash}_{processo}_{numero}"
-
-def sha_full_raw_text(entry) -> str:
-    raw_text = entry[0]
-    return hashlib.sha1(raw_text.encode("utf-8")).hexdigest()[:12]
+    return bhash(txt.encode("utf-8"))
+
+def make_composite_key(df: pd.DataFrame) -> pd.Series:
+    obj_hash = pd.Series([sha12(obj) if obj else "no_obj_hash" for obj in df["obj_norm"]],
+                         index=df.index)
+    processo = df["processo_gdf"].fillna("unknown_processo")
+    numero = df["numero_contrato"].fillna("unknown_numero")
+    return obj_hash + "_" + processo + "_" + numero
+
+def sha_full_raw_text(raw_text: pd.Series) -> list[str]:
+    return [sha12(txt) for txt in raw_text]
+
+def load_dataset(path: str = PICKLE_IN) -> list:
+    """Carrega só os EXTRATO_CONTRATO do pickle, com o GC cíclico desligado durante o load."""
+    # pickle.load aloca um objeto por string/tupla; sem gc.disable() o coletor
+    # varre repetidamente o grafo inteiro enquanto ele cresce, sem nada a coletar.
+    gc.disable()
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)["EXTRATO_CONTRATO"]
+    finally:
+        gc.enable()
 
 def main():
-    with open(PICKLE_IN, "rb") as f:
-        dataset = pickle.load(f)["EXTRATO_CONTRATO"]
-
-    rows = []
-    for entry in dataset:
-        meta = dict(entry[1:])
-        obj = meta.get("objeto_contrato")
-        val = meta.get("valor_contrato")
-        if not (obj and val):
-            continue
-
-        obj_norm = re.sub(r"\s+", " ", obj).strip()
-        val_norm = normalize_valor(val)
-        if not val_norm:
-            continue
-
-        composite_key = make_composite_key(meta)
-        raw_text_hash = sha_full_raw_text(entry)
-
-        rows.append({
-            "composite_key": composite_key,
-            "objeto_contrato": obj_norm,
-            "valor_contrato": val_norm,
-            "processo_gdf": meta.get("processo_gdf", ""),
-            "numero_contrato": meta.get("numero_contrato", ""),
-            "raw_text_hash": raw_text_hash
-        })
-
-    df = pd.DataFrame(rows)
-
-    # Drop duplicates keeping first occurrence
+    dataset = load_dataset()
+    df = pd.DataFrame([dict(entry[1:], raw=entry[0]) for entry in dataset])
+    del dataset  # o DataFrame já tem tudo; libera a lista antes da limpeza
+    df = df.reindex(columns=["raw", *META_COLS])
+
+    has_fields = (df["objeto_contrato"].fillna("").str.len().gt(0)
+                  & df["valor_contrato"].fillna("").str.len().gt(0))
+    df = df[has_fields].copy()
+
+    df["valor_contrato"] = normalize_valor(df["valor_contrato"])
+    df = df[df["valor_contrato"].notna()].copy()
+
+    df["obj_norm"] = df["objeto_contrato"].str.replace(_WS_RE, " ", regex=True).str.strip()
+    df["composite_key"] = make_composite_key(df)
+    df["raw_text_hash"] = sha_full_raw_text(df["raw"])
+    # After `del dataset` this column holds the only references to the full raw
+    # texts; drop it as soon as it is hashed so they are freed before dedup
+    df = df.drop(columns="raw")
+
+    # Drop duplicates keeping first occurrence, before building the output frame
     df = df.drop_duplicates(subset=["composite_key", "raw_text_hash"])
 
+    df = pd.DataFrame({
+        "composite_key": df["composite_key"],
+        "objeto_contrato": df["obj_norm"],
+        "valor_contrato": df["valor_contrato"],
+        "processo_gdf": df["processo_gdf"].fillna(""),
+        "numero_contrato": df["numero_contrato"].fillna(""),
+        "raw_text_hash": df["raw_text_hash"],
+    })
+
     # Mark version index within each composite_key group
-    df["versao_idx"] = df.groupby("composite_key").cumcount()
+    # (sort=False: cumcount follows row order anyway, no need to sort the keys)
+    df["versao_idx"] = df.groupby("composite_key", sort=False).cumcount()
 
-    df.to_csv(CSV_OUT, index=False, encoding="utf-8")
+    # writer C++ do Arrow (UTF-8), bem mais rápido que df.to_csv para colunas de texto
+    tbl = pa.Table.from_pandas(df, preserve_index=False)
+    pacsv.write_csv(tbl, CSV_OUT, write_options=pacsv.WriteOptions(include_header=True))
     print(f"✅ {len(df)} rows saved to {CSV_OUT}")
 
 if __name__ == "__main__":
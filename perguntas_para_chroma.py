@@ -1,55 +1,105 @@
-import json
-import os
+import chromadb
+import numpy as np
+import orjson
+import torch
+from sentence_transformers import SentenceTransformer
 
-from langchain.embeddings import OpenAIEmbeddings
-from langchain.vectorstores import Chroma
+# Chroma recommends inserting in batches of a few hundred records
+BATCH_SIZE = 200
+COLLECTION_NAME = "qa"
+
+# Local multilingual model: the QA pairs are in Portuguese
+EMBED_MODEL = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+EMBED_BATCH_SIZE = 256
 
 
 def load_jsonl(filepath):
-    """Load JSONL file and yield each json object."""
-    with open(filepath, "r", encoding="utf-8") as f:
+    """Load JSONL file and yield each json object (bytes go straight to orjson)."""
+    with open(filepath, "rb", buffering=1 << 20) as f:
         for line in f:
-            yield json.loads(line)
+            if line.strip():
+                yield orjson.loads(line)
+
+def embed_texts(texts):
+    """Embed texts locally, on the GPU in fp16 when one is available."""
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model = SentenceTransformer(EMBED_MODEL, device=device)
+    if device == "cuda":
+        model.half()
+    return model.encode(texts, batch_size=EMBED_BATCH_SIZE, convert_to_numpy=True,
+                        normalize_embeddings=True, show_progress_bar=True)
+
+def int8_scale(vecs):
+    """Per-dimension affine scale mapping each column's max |value| onto 127."""
+    scale = np.abs(vecs).max(axis=0).astype(np.float32) / 127.0
+    return np.where(scale > 0, scale, 1.0).astype(np.float32)
+
+def quantize_int8(vecs, scale):
+    """Quantize embeddings to int8 codes with the scale from int8_scale()."""
+    return np.clip(np.round(vecs / scale), -127, 127).astype(np.int8)
+
+def dequantize_int8(q, scale):
+    """Map int8 codes back to the model's embedding space (up to quantization error)."""
+    return (q * scale).astype(np.float32)
 
 def main():
     # Path to your JSONL file
     jsonl_path = "your_data.jsonl"
 
-    # Prepare data for embedding
-    texts = []
-    metadatas = []
-
     print("Loading and preparing data...")
-    for entry in load_jsonl(jsonl_path):
-        # Combine relevant fields as context for embedding
-        combined_text = f"{entry['question']} {entry['objeto']} {entry['answer']} {entry['valor']}"
-        texts.append(combined_text)
-
-        # Keep metadata such as ID and question for reference
-        metadatas.append({
-            "id": entry.get("id", ""),
-            "question": entry.get("question", ""),
-            "answer": entry.get("answer", ""),
-            "objeto": entry.get("objeto", ""),
-            "valor": entry.get("valor", "")
-        })
+    # Keep metadata such as ID and question for reference
+    metadatas = [{
+        "id": entry.get("id", ""),
+        "question": entry.get("question", ""),
+        "answer": entry.get("answer", ""),
+        "objeto": entry.get("objeto", ""),
+        "valor": entry.get("valor", "")
+    } for entry in load_jsonl(jsonl_path)]
 
-    print(f"Loaded {len(texts)} documents.")
+    # Combine relevant fields as context for embedding
+    texts = [f"{m['question']} {m['objeto']} {m['answer']} {m['valor']}" for m in metadatas]
 
-    # Create OpenAI embedding model instance
-    embedding = OpenAIEmbeddings()
+    print(f"Loaded {len(texts)} documents.")
 
     # Create (or load) Chroma vector store
     persist_directory = "./chroma_db"
+    client = chromadb.PersistentClient(path=persist_directory)
+    collection = client.get_or_create_collection(COLLECTION_NAME)
 
-    if os.path.exists(persist_directory):
+    if collection.count():
         print("Loading existing Chroma database...")
-        vectorstore = Chroma(persist_directory=persist_directory, embedding_function=embedding)
-    else:
-        print("Creating new Chroma database and adding documents...")
-        vectorstore = Chroma.from_texts(texts=texts, embedding=embedding, metadatas=metadatas, persist_directory=persist_directory)
-        vectorstore.persist()
-        print("Chroma database saved.")
+        return
+
+    if not texts:
+        print("No documents to add.")
+        return
+
+    print("Creating new Chroma database and adding documents...")
+    # Embeddings are computed here in bulk, not by Chroma
+    print(f"Embedding {len(texts)} documents with {EMBED_MODEL}...")
+    vectors = embed_texts(texts)
+
+    # Snap to a per-dimension int8 grid and store the dequantized values, so plain
+    # query embeddings still match. Chroma stores float32 regardless: this only
+    # makes the stored vectors less precise, it does not shrink or speed up the
+    # index. The scale is kept with the collection to recover the int8 codes.
+    scale = int8_scale(vectors)
+    vectors = dequantize_int8(quantize_int8(vectors, scale), scale)
+    collection.modify(metadata={"int8_scale": orjson.dumps(scale.tolist()).decode()})
+
+    # Respect the server-side limit on records per add()
+    batch_size = min(BATCH_SIZE, client.get_max_batch_size())
+    # Position in the JSONL as id: the "id" field is not unique across records
+    ids = [str(i) for i in range(len(texts))]
+    for start in range(0, len(texts), batch_size):
+        end = start + batch_size
+        collection.add(
+            ids=ids[start:end],
+            embeddings=vectors[start:end].tolist(),
+            metadatas=metadatas[start:end],
+            documents=texts[start:end],
+        )
+    print("Chroma database saved.")
 
 if __name__ == "__main__":
     main()